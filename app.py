@@ -4,8 +4,18 @@ import os
 from pathlib import Path
 import plotly.express as px
 import plotly.graph_objects as go
+import plotly.io as pio
 from datetime import datetime
 import numpy as np
+import hashlib
+import importlib.util
+import io
+import gzip
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+# Use the Rust-based calamine reader when it is installed
+HAS_CALAMINE = importlib.util.find_spec("python_calamine") is not None
 
 # Set page config
 st.set_page_config(
@@ -17,24 +27,103 @@ st.set_page_config(
 # Create directories if they don't exist
 UPLOAD_DIR = Path("uploaded_files")
 DATA_DIR = Path("data")
+CACHE_DIR = DATA_DIR / "cache"
 UPLOAD_DIR.mkdir(exist_ok=True)
 DATA_DIR.mkdir(exist_ok=True)
+CACHE_DIR.mkdir(exist_ok=True)
+
+# Excel reading options: openpyxl read-only mode and column types declared up front
+EXCEL_ENGINE_KWARGS = {"read_only": True, "data_only": True}
+EXCEL_TYPES = ['xlsx', 'xlsb']
+COLUMN_DTYPES = {'codigo': 'string', 'CODIGO': 'string', 'CALIDAD': 'category', 'ORIGEN': 'category'}
+DATE_COLUMNS = ['fecha_entrada_caja', 'fecha_preparación_caja']
+
+# Columns used by the analysis, across both sheets
+ANALYSIS_COLUMNS = ('codigo', 'CODIGO', 'valor', 'CALIDAD', 'ORIGEN', 'FAMILIA', *DATE_COLUMNS)
+
+# Number of rows shown per page in the data preview
+PAGE_SIZE = 1000
+
+# Version of the data produced by load_excel; bump it whenever its output changes
+CACHE_VERSION = 2
+
+# Function to build the on-disk cache key for a file
+def get_cache_key(file_path, usecols=None):
+    stat = os.stat(file_path)
+    key = f"{CACHE_VERSION}:{file_path}:{stat.st_mtime}:{stat.st_size}:{usecols}"
+    return hashlib.blake2b(key.encode()).hexdigest()[:16]
+
+# Function to convert a date column read from Excel
+def parse_date_column(col):
+    if pd.api.types.is_numeric_dtype(col):
+        # Binary workbooks return dates as Excel serial day numbers
+        return pd.to_datetime(col, unit='D', origin='1899-12-30')
+    return pd.to_datetime(col, format='%d/%m/%y', cache=True)
 
 # Function to load Excel file
 @st.cache_data
-def load_excel(file_path):
+def load_excel(file_path, usecols=None):
     try:
-        # Read both sheets
-        entradas_df = pd.read_excel(file_path, sheet_name='Entradas')
-        familias_df = pd.read_excel(file_path, sheet_name='Familias')
+        # Reuse the Parquet cache if this exact file was already parsed
+        source = hashlib.blake2b(str(file_path).encode(), digest_size=8).hexdigest()
+        key = get_cache_key(file_path, usecols)
+        cache_paths = [CACHE_DIR / f"{source}_{key}_{name}.parquet" for name in ('entradas', 'familias', 'merged')]
+        if all(path.exists() for path in cache_paths):
+            return tuple(pd.read_parquet(path) for path in cache_paths)
+        
+        # calamine reads both formats; otherwise binary workbooks need pyxlsb and the rest openpyxl
+        if HAS_CALAMINE:
+            engine, engine_kwargs = 'calamine', None
+        elif Path(file_path).suffix.lower() == '.xlsb':
+            engine, engine_kwargs = 'pyxlsb', None
+        else:
+            engine, engine_kwargs = 'openpyxl', EXCEL_ENGINE_KWARGS
+        
+        # Read both sheets from a single workbook open, skipping unwanted columns
+        sheets = pd.read_excel(file_path, sheet_name=['Entradas', 'Familias'], engine=engine,
+                               engine_kwargs=engine_kwargs, dtype=COLUMN_DTYPES,
+                               usecols=(lambda col: col in usecols) if usecols else None)
+        entradas_df, familias_df = sheets['Entradas'], sheets['Familias']
         
-        # Convert date columns
-        date_columns = ['fecha_entrada_caja', 'fecha_preparación_caja']
-        for col in date_columns:
-            entradas_df[col] = pd.to_datetime(entradas_df[col], format='%d/%m/%y')
+        # Convert date columns; repeated dates are parsed only once
+        entradas_df[DATE_COLUMNS] = entradas_df[DATE_COLUMNS].apply(parse_date_column)
         
-        # Merge dataframes
-        merged_df = pd.merge(entradas_df, familias_df, left_on='codigo', right_on='CODIGO', how='left')
+        # Codes as categories so each family lookup runs once per distinct code
+        entradas_df['codigo'] = entradas_df['codigo'].astype('category')
+        
+        # Find the Familias row for every codigo; -1 marks codes missing from Familias
+        familias_lookup = familias_df.drop_duplicates('CODIGO').set_index('CODIGO')
+        codigo = entradas_df['codigo'].cat
+        rows = np.append(familias_lookup.index.get_indexer(codigo.categories), -1)[codigo.codes.to_numpy()]
+        
+        # Add the family columns, keeping their dtypes as pd.merge does
+        shared_columns = familias_lookup.columns.intersection(entradas_df.columns)
+        merged_df = entradas_df.rename(columns={col: f"{col}_x" for col in shared_columns})
+        for col in familias_lookup.columns:
+            # Columns present in both sheets keep both values, suffixed as pd.merge does
+            target = f"{col}_y" if col in shared_columns else col
+            merged_df[target] = pd.api.extensions.take(familias_lookup[col].array, rows, allow_fill=True)
+        
+        # Grouping columns as categories so counting hashes integer codes
+        for col in ['CALIDAD', 'ORIGEN', 'FAMILIA']:
+            merged_df[col] = merged_df[col].astype('category')
+        merged_df['valor'] = pd.to_numeric(merged_df['valor'], downcast='float')
+        
+        # Add month and year columns for analysis; only the distinct months are formatted
+        months = merged_df['fecha_entrada_caja'].dt.to_period('M').astype('category')
+        merged_df['mes'] = months.cat.rename_categories(lambda month: month.strftime('%Y-%m'))
+        merged_df['año'] = merged_df['fecha_entrada_caja'].dt.year.astype('Int32')
+        
+        # Drop older caches of the same file, then store the parsed data so later loads skip the Excel parsing
+        for path in CACHE_DIR.glob(f"{source}_*.parquet"):
+            path.unlink(missing_ok=True)
+        try:
+            for df, path in zip((entradas_df, familias_df, merged_df), cache_paths):
+                df.to_parquet(path, compression='zstd')
+        except Exception:
+            # Columns with mixed types cannot be written; keep working without the cache
+            for path in cache_paths:
+                path.unlink(missing_ok=True)
         
         return entradas_df, familias_df, merged_df
     except Exception as e:
@@ -44,116 +133,146 @@ def load_excel(file_path):
 # Function to save uploaded file
 def save_uploaded_file(uploaded_file):
     try:
-        file_path = UPLOAD_DIR / uploaded_file.name
-        with open(file_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
+        # Name the file after its content so re-uploads are not written again
+        buffer = uploaded_file.getbuffer()
+        content_hash = hashlib.blake2b(buffer, digest_size=8).hexdigest()
+        file_path = UPLOAD_DIR / f"{content_hash}_{uploaded_file.name}"
+        if not file_path.exists():
+            with open(file_path, "wb") as f:
+                f.write(buffer)
+            list_uploaded_files.clear()
         return file_path
     except Exception as e:
         st.error(f"Error al guardar el archivo: {str(e)}")
         return None
 
-# Sidebar for file management
-st.sidebar.title("Gestión de Archivos")
+# Function to list previously uploaded files
+@st.cache_data(ttl=5)
+def list_uploaded_files():
+    return sorted(path.name for file_type in EXCEL_TYPES for path in UPLOAD_DIR.glob(f'*.{file_type}'))
 
-# Check for default file in data folder
-default_file = DATA_DIR / "data.xlsx"
-if default_file.exists():
-    st.sidebar.info("Archivo por defecto encontrado en la carpeta data")
-    entradas_df, familias_df, merged_df = load_excel(default_file)
-else:
-    st.sidebar.warning("No se encontró el archivo por defecto en la carpeta data")
-    entradas_df, familias_df, merged_df = None, None, None
-
-# File uploader
-uploaded_file = st.sidebar.file_uploader("Subir archivo Excel", type=['xlsx'])
+# Function to compute the proportion of each CALIDAD value per group
+def quality_by(df, col):
+    return pd.crosstab(df[col], df['CALIDAD'], normalize='index')
 
-# List previously uploaded files
-previous_files = [f for f in os.listdir(UPLOAD_DIR) if f.endswith('.xlsx')]
-if previous_files:
-    st.sidebar.subheader("Archivos subidos anteriormente")
-    selected_file = st.sidebar.selectbox("Seleccionar archivo", previous_files)
-    if selected_file:
-        file_path = UPLOAD_DIR / selected_file
-        entradas_df, familias_df, merged_df = load_excel(file_path)
-
-# Main content
-st.title("Analizador de Datos Excel")
+# Function to compute average and total value per month
+def value_by_month(df):
+    # Accumulate in float64 so monthly totals keep full precision
+    values = df['valor'].astype('float64')
+    return values.groupby(df['mes'], observed=True).agg(['mean', 'sum']).reset_index()
 
-if uploaded_file:
-    file_path = save_uploaded_file(uploaded_file)
-    if file_path:
-        entradas_df, familias_df, merged_df = load_excel(file_path)
+# Function to compute the box plot statistics of value per quality
+def value_stats_by_quality(df):
+    return df.groupby('CALIDAD', observed=True)['valor'].describe(percentiles=[.25, .5, .75])
 
-if entradas_df is not None and familias_df is not None and merged_df is not None:
-    # Display data preview
-    st.subheader("Vista Previa de Datos")
-    
-    tab1, tab2, tab3 = st.tabs(["Entradas", "Familias", "Datos Combinados"])
-    
-    with tab1:
-        st.dataframe(entradas_df)
-        st.write("Información de Columnas:")
-        st.write(entradas_df.dtypes)
-    
-    with tab2:
-        st.dataframe(familias_df)
-        st.write("Información de Columnas:")
-        st.write(familias_df.dtypes)
-    
-    with tab3:
-        st.dataframe(merged_df)
-        st.write("Información de Columnas:")
-        st.write(merged_df.dtypes)
-    
-    # Statistics and Visualizations
-    st.subheader("Análisis de Datos")
+# Function to compute average value per origin and quality
+def avg_value_by_origin_quality(df):
+    origins = df['ORIGEN'].cat.categories
+    qualities = df['CALIDAD'].cat.categories
+    origin_codes = df['ORIGEN'].cat.codes.to_numpy(np.intp)
+    quality_codes = df['CALIDAD'].cat.codes.to_numpy(np.intp)
+    values = df['valor'].to_numpy(np.float64)
     
-    # Add month column for analysis
-    merged_df['mes'] = merged_df['fecha_entrada_caja'].dt.strftime('%Y-%m')
-    merged_df['año'] = merged_df['fecha_entrada_caja'].dt.year
-    
-    # Plot selection
-    plot_type = st.selectbox(
-        "Seleccionar Tipo de Gráfico",
-        [
-            "Distribución de Calidad por Mes",
-            "Distribución de Calidad por Origen",
-            "Distribución de Valores por Calidad",
-            "Valor por Mes",
-            "Distribución de Calidad por Familia",
-            "Valor Promedio por Origen y Calidad"
-        ]
-    )
+    # Accumulate sums and counts into a flattened (origin, quality) matrix in one pass
+    valid = (origin_codes >= 0) & (quality_codes >= 0) & ~np.isnan(values)
+    cells = origin_codes[valid] * len(qualities) + quality_codes[valid]
+    size = len(origins) * len(qualities)
+    counts = np.bincount(cells, minlength=size)
+    sums = np.bincount(cells, weights=values[valid], minlength=size)
     
+    # Keep only the combinations present in the data
+    observed = np.flatnonzero(counts)
+    origin_idx, quality_idx = np.divmod(observed, len(qualities))
+    return pd.DataFrame({
+        'ORIGEN': origins[origin_idx],
+        'CALIDAD': qualities[quality_idx],
+        'valor': sums[observed] / counts[observed]
+    })
+
+# Function to check whether pyarrow writes a column type the same way as DataFrame.to_csv
+def arrow_writes_like_pandas(arrow_type):
+    if pa.types.is_dictionary(arrow_type):
+        return pa.types.is_string(arrow_type.value_type) or pa.types.is_large_string(arrow_type.value_type)
+    if pa.types.is_timestamp(arrow_type):
+        return arrow_type.tz is None
+    return not (pa.types.is_boolean(arrow_type) or pa.types.is_time(arrow_type) or pa.types.is_duration(arrow_type))
+
+# Function to serialise a dataframe as gzip-compressed CSV bytes, cached per file
+@st.cache_data
+def to_csv_gzip(_df, file_hash):
+    csv = None
+    try:
+        table = pa.Table.from_pandas(_df, preserve_index=False)
+        if all(arrow_writes_like_pandas(field.type) for field in table.schema):
+            for i, col in enumerate(table.column_names):
+                if pa.types.is_timestamp(table.schema.field(i).type):
+                    # Write dates without a time part as plain dates, like DataFrame.to_csv
+                    dates = _df[col]
+                    target = pa.date32() if dates.dt.normalize().equals(dates) else pa.timestamp('s')
+                    table = table.set_column(i, col, table.column(i).cast(target))
+            buffer = io.BytesIO()
+            pacsv.write_csv(table, buffer)
+            csv = buffer.getvalue()
+    except pa.ArrowException:
+        # Columns with mixed types (or sub-second times) cannot be written by pyarrow
+        pass
+    if csv is None:
+        csv = _df.to_csv(index=False).encode()
+    return gzip.compress(csv, compresslevel=1)
+
+# Function to display one page of a dataframe with its column types
+def show_dataframe(df, key):
+    start = st.number_input("Fila inicial", min_value=0, max_value=max(len(df) - 1, 0),
+                            step=PAGE_SIZE, key=f"{key}_offset")
+    end = min(start + PAGE_SIZE, len(df))
+    st.dataframe(df.iloc[start:end])
+    st.caption(f"Filas {start} a {end} de {len(df)}")
+    st.write("Información de Columnas:")
+    st.write(df.dtypes.astype(str).to_frame('dtype'))
+
+# Function to build the figure for a plot type, cached as JSON per file
+@st.cache_data
+def build_figure(_df, plot_type, file_hash):
     if plot_type == "Distribución de Calidad por Mes":
         # Calculate proportions
-        quality_by_month = merged_df.groupby(['mes', 'CALIDAD']).size().unstack(fill_value=0)
-        quality_by_month = quality_by_month.div(quality_by_month.sum(axis=1), axis=0)
+        quality_by_month = quality_by(_df, 'mes')
         
         fig = px.bar(quality_by_month, 
                     title="Proporción de valores de CALIDAD por Mes",
                     labels={'value': 'Proporción', 'mes': 'Mes', 'CALIDAD': 'Calidad'})
-        st.plotly_chart(fig, use_container_width=True)
     
     elif plot_type == "Distribución de Calidad por Origen":
         # Calculate proportions
-        quality_by_origin = merged_df.groupby(['ORIGEN', 'CALIDAD']).size().unstack(fill_value=0)
-        quality_by_origin = quality_by_origin.div(quality_by_origin.sum(axis=1), axis=0)
+        quality_by_origin = quality_by(_df, 'ORIGEN')
         
         fig = px.bar(quality_by_origin,
                     title="Proporción de valores de CALIDAD por Origen",
                     labels={'value': 'Proporción', 'ORIGEN': 'Origen', 'CALIDAD': 'Calidad'})
-        st.plotly_chart(fig, use_container_width=True)
     
     elif plot_type == "Distribución de Valores por Calidad":
-        fig = px.box(merged_df, x='CALIDAD', y='valor',
-                    title="Distribución de Valores por Calidad",
-                    labels={'valor': 'Valor', 'CALIDAD': 'Calidad'})
-        st.plotly_chart(fig, use_container_width=True)
+        # Draw the boxes from precomputed statistics instead of sending every row
+        stats = value_stats_by_quality(_df)
+        fig = go.Figure(
+            go.Box(
+                x=stats.index.astype(str),
+                q1=stats['25%'],
+                median=stats['50%'],
+                q3=stats['75%'],
+                lowerfence=stats['min'],
+                upperfence=stats['max'],
+                mean=stats['mean'],
+                name="Valor"
+            )
+        )
+        fig.update_layout(
+            title="Distribución de Valores por Calidad",
+            xaxis_title="Calidad",
+            yaxis_title="Valor"
+        )
     
     elif plot_type == "Valor por Mes":
         # Calculate average value by month
-        value_by_month = merged_df.groupby('mes')['valor'].agg(['mean', 'sum']).reset_index()
+        monthly_values = value_by_month(_df)
         
         # Create figure with secondary y-axis
         fig = go.Figure()
@@ -161,8 +280,8 @@ if entradas_df is not None and familias_df is not None and merged_df is not None
         # Add average value line
         fig.add_trace(
             go.Scatter(
-                x=value_by_month['mes'],
-                y=value_by_month['mean'],
+                x=monthly_values['mes'],
+                y=monthly_values['mean'],
                 name="Valor Promedio",
                 line=dict(color='blue')
             )
@@ -171,8 +290,8 @@ if entradas_df is not None and familias_df is not None and merged_df is not None
         # Add total value bars
         fig.add_trace(
             go.Bar(
-                x=value_by_month['mes'],
-                y=value_by_month['sum'],
+                x=monthly_values['mes'],
+                y=monthly_values['sum'],
                 name="Valor Total",
                 yaxis="y2",
                 opacity=0.5
@@ -191,34 +310,106 @@ if entradas_df is not None and familias_df is not None and merged_df is not None
             ),
             showlegend=True
         )
-        
-        st.plotly_chart(fig, use_container_width=True)
     
     elif plot_type == "Distribución de Calidad por Familia":
-        quality_by_family = merged_df.groupby(['FAMILIA', 'CALIDAD']).size().unstack(fill_value=0)
-        quality_by_family = quality_by_family.div(quality_by_family.sum(axis=1), axis=0)
+        quality_by_family = quality_by(_df, 'FAMILIA')
         
         fig = px.bar(quality_by_family,
                     title="Distribución de Calidad por Familia",
                     labels={'value': 'Proporción', 'FAMILIA': 'Familia', 'CALIDAD': 'Calidad'})
-        st.plotly_chart(fig, use_container_width=True)
     
     elif plot_type == "Valor Promedio por Origen y Calidad":
-        avg_value = merged_df.groupby(['ORIGEN', 'CALIDAD'])['valor'].mean().reset_index()
+        avg_value = avg_value_by_origin_quality(_df)
         fig = px.bar(avg_value, x='ORIGEN', y='valor', color='CALIDAD',
                     title="Valor Promedio por Origen y Calidad",
                     labels={'valor': 'Valor Promedio', 'ORIGEN': 'Origen', 'CALIDAD': 'Calidad'})
-        st.plotly_chart(fig, use_container_width=True)
+    
+    return pio.to_json(fig)
+
+# Sidebar for file management
+st.sidebar.title("Gestión de Archivos")
+
+# Restrict parsing to the columns used by the analysis
+usecols = ANALYSIS_COLUMNS if st.sidebar.checkbox("Cargar solo columnas de análisis") else None
+
+# Check for default file in data folder
+default_file = DATA_DIR / "data.xlsx"
+if default_file.exists():
+    st.sidebar.info("Archivo por defecto encontrado en la carpeta data")
+    active_path = default_file
+else:
+    st.sidebar.warning("No se encontró el archivo por defecto en la carpeta data")
+    active_path = None
+
+# File uploader
+uploaded_file = st.sidebar.file_uploader("Subir archivo Excel", type=EXCEL_TYPES)
+
+# List previously uploaded files
+previous_files = list_uploaded_files()
+if previous_files:
+    st.sidebar.subheader("Archivos subidos anteriormente")
+    selected_file = st.sidebar.selectbox("Seleccionar archivo", previous_files)
+    if selected_file:
+        active_path = UPLOAD_DIR / selected_file
+
+# Main content
+st.title("Analizador de Datos Excel")
+
+if uploaded_file:
+    file_path = save_uploaded_file(uploaded_file)
+    if file_path:
+        active_path = file_path
+
+# Load only the file that takes priority: uploaded, then selected, then default
+if active_path:
+    entradas_df, familias_df, merged_df = load_excel(active_path, usecols)
+else:
+    entradas_df, familias_df, merged_df = None, None, None
+
+if entradas_df is not None and familias_df is not None and merged_df is not None:
+    # Display data preview
+    st.subheader("Vista Previa de Datos")
+    
+    tab1, tab2, tab3 = st.tabs(["Entradas", "Familias", "Datos Combinados"])
+    
+    with tab1:
+        show_dataframe(entradas_df, 'entradas')
+    
+    with tab2:
+        show_dataframe(familias_df, 'familias')
+    
+    with tab3:
+        show_dataframe(merged_df, 'merged')
+    
+    # Statistics and Visualizations
+    st.subheader("Análisis de Datos")
+    
+    # Plot selection; figures are cached per file and plot type
+    file_hash = get_cache_key(active_path, usecols)
+    plot_type = st.selectbox(
+        "Seleccionar Tipo de Gráfico",
+        [
+            "Distribución de Calidad por Mes",
+            "Distribución de Calidad por Origen",
+            "Distribución de Valores por Calidad",
+            "Valor por Mes",
+            "Distribución de Calidad por Familia",
+            "Valor Promedio por Origen y Calidad"
+        ]
+    )
+    
+    fig = pio.from_json(build_figure(merged_df, plot_type, file_hash))
+    st.plotly_chart(fig, use_container_width=True)
     
     # Download options
     st.subheader("Descargar Datos")
     if st.button("Descargar Datos Combinados como CSV"):
-        csv = merged_df.to_csv(index=False)
+        csv = to_csv_gzip(merged_df, file_hash)
         st.download_button(
             label="Descargar CSV",
             data=csv,
-            file_name="datos_combinados.csv",
-            mime="text/csv"
+            file_name="datos_combinados.csv.gz",
+            mime="application/gzip"
         )
 else:
     st.info("Por favor, suba un archivo Excel para comenzar el análisis.") 
\ No newline at end of file